@@ -1,313 +1,456 @@
-#!/usr/bin/env python3
-# Telegram Chatbot https://github.com/dhjw/telegram-chatbot
-import os, logging, json, functools, time
-from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from inc.chat_completion import ChatCompletionClient
-
-# Enable logging
-logging.basicConfig(
-	format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-	level=logging.INFO
-)
-logger = logging.getLogger(__name__)
-
-# Change current working directory
-os.chdir(os.path.dirname(os.path.abspath(__file__)))
-
-# Load config
-try:
-	with open('./config.json', 'r') as f:
-		config = json.loads(f.read())
-except Exception as e:
-	logger.critical('Error loading config.json: %s', e)
-	quit()
-
-# Initialize ChatCompletionClient
-try:
-	client = ChatCompletionClient(config['chat_providers'])
-except Exception as e:
-	logger.critical('Error initializing ChatCompletionClient: %s', e)
-	quit()
-
-
-# Helper for chat ID authorization
-def is_chat_authorized(update: Update) -> bool:
-	if config['misc_options'].get('enforce_chat_ids', False):
-		allowed_chat_ids = config['misc_options'].get('allow_chat_ids', [])
-		if allowed_chat_ids: # Enforce if list not empty
-			chat_id = update.effective_chat.id
-			if chat_id not in allowed_chat_ids:
-				logger.info(f"Ignoring unauthorized chat ID: {chat_id}")
-				return False
-	return True
-
-
-# Define command handlers
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-	"""Sends a message with available commands."""
-	logger.info('help_command() update: %s', update)
-
-	if not is_chat_authorized(update):
-		return # Ignore unauthorized chat
-
-	help_text = "Available commands:\n/help\n"
-
-	for provider_config in config['chat_providers']:
-		wipe_subcmd_display = ""
-		if config['chat_options'].get('memory_enabled', False) and config['chat_options'].get('memory_wipe_subcmd'):
-			wipe_subcmd_display = f" | {config['chat_options']['memory_wipe_subcmd']}"
-		help_text += f"/{provider_config['cmd']} <text>{wipe_subcmd_display}\n"
-
-	if update.effective_message:
-		await update.effective_message.reply_text(help_text)
-
-
-async def chat(update: Update, context: ContextTypes.DEFAULT_TYPE, provider_config: dict) -> None:
-	"""Handles chat commands for different providers."""
-	if not is_chat_authorized(update):
-		return # Ignore unauthorized chat
-
-	display_name = provider_config.get('name', provider_config['cmd'])
-	provider_cmd = provider_config['cmd'] # Memory key
-
-	# Get message object
-	message_to_process = update.edited_message if update.edited_message else update.message
-
-	if not message_to_process:
-		logger.warning("Chat update without effective message.")
-		return # No reply
-
-	chat_id = message_to_process.chat_id
-	user_message_id = message_to_process.message_id # User's message ID
-
-	# Initialize bot_replies in chat_data
-	if 'bot_replies' not in context.chat_data:
-		context.chat_data['bot_replies'] = {}
-
-	# Get ID of bot's previous reply
-	bot_reply_id_for_edit = context.chat_data['bot_replies'].get(user_message_id)
-
-	try:
-		# Send "Please wait..." for EDITED messages only
-		if update.edited_message and bot_reply_id_for_edit:
-			try:
-				await context.bot.edit_message_text(
-					chat_id=chat_id,
-					message_id=bot_reply_id_for_edit,
-					text="Please wait...",
-					parse_mode=None
-				)
-				logger.info('Edited previous bot response to "Please wait..." for user message ID %s', user_message_id)
-			except Exception as edit_e:
-				logger.warning('Failed to edit message %s to "Please wait..." (error: %s). Proceeding without update.', bot_reply_id_for_edit, edit_e)
-
-		# If no arguments, show help text
-		if not context.args:
-			await help_command(update, context)
-			return
-
-		user_query = " ".join(context.args)
-		logger.info('Incoming query for %s (cmd: %s): %s', display_name, provider_cmd, user_query)
-
-		# Handle memory wipe subcommand
-		memory_wipe_subcmd = config['chat_options'].get('memory_wipe_subcmd')
-		if memory_wipe_subcmd and user_query.strip().lower().startswith(memory_wipe_subcmd.lower()):
-			if config['chat_options'].get('memory_enabled', False):
-				chat_memories = context.chat_data.setdefault('chat_memories', {})
-				if provider_cmd in chat_memories:
-					wiped_count = len(chat_memories[provider_cmd])
-					chat_memories[provider_cmd].clear()
-					logger.info('Memory for provider %s wiped. %d pairs removed.', provider_cmd, wiped_count)
-
-				response_content = "Memory erased."
-			else:
-				response_content = "Memory is not enabled."
-
-			# Send/Edit "Memory erased." message
-			if bot_reply_id_for_edit:
-				try:
-					await context.bot.edit_message_text(
-						chat_id=chat_id,
-						message_id=bot_reply_id_for_edit,
-						text=response_content,
-						parse_mode=None
-					)
-				except Exception as edit_e:
-					logger.warning('Failed to edit message %s with "Memory erased." (error: %s). Sending new message.', bot_reply_id_for_edit, edit_e)
-					await message_to_process.reply_text(response_content, parse_mode=None)
-			else:
-				new_reply = await message_to_process.reply_text(response_content, parse_mode=None)
-				context.chat_data['bot_replies'][user_message_id] = new_reply.message_id
-			return # Exit after memory wipe
-
-		# Prepare messages for LLM, including memory
-		messages_for_llm = []
-		chat_completion_system_prompt = None
-
-		if config['chat_options'].get('memory_enabled', False):
-			chat_memories = context.chat_data.setdefault('chat_memories', {})
-			provider_memory = chat_memories.setdefault(provider_cmd, [])
-
-			current_time = time.time()
-			memory_expires = config['chat_options'].get('memory_expires', 0)
-			memory_max_pairs = config['chat_options'].get('memory_max_pairs', 0)
-
-			if config["chat_options"].get("system_prompt"):
-				messages_for_llm.append({"role": "system", "content": config["chat_options"]["system_prompt"]})
-
-			# Clean up expired messages
-			if memory_expires > 0:
-				initial_memory_count = len(provider_memory)
-				provider_memory[:] = [
-					entry for entry in provider_memory if (current_time - entry['timestamp']) < memory_expires
-				]
-				removed_count_expires = initial_memory_count - len(provider_memory)
-				if removed_count_expires > 0:
-					logger.debug('Removed %d expired memory pairs for %s. Remaining: %d.', removed_count_expires, provider_cmd, len(provider_memory))
-
-			# Handle Edited Message Memory Update
-			if update.edited_message:
-				initial_user_message_id = update.edited_message.message_id
-				initial_memory_count = len(provider_memory)
-				provider_memory[:] = [
-					entry for entry in provider_memory if entry.get('user_message_id') != initial_user_message_id
-				]
-				removed_count_edited = initial_memory_count - len(provider_memory)
-				if removed_count_edited > 0:
-					logger.debug('Removed %d old memory pair(s) for edited message ID %s. Remaining: %d.', removed_count_edited, initial_user_message_id, len(provider_memory))
-
-			# Enforce max_pairs limit
-			if memory_max_pairs > 0:
-				removed_count_max_pairs = 0
-				while len(provider_memory) > memory_max_pairs:
-					provider_memory.pop(0)
-					removed_count_max_pairs += 1
-				if removed_count_max_pairs > 0:
-					logger.debug('Removed %d memory pairs due to max_pairs limit for %s. Remaining: %d.', removed_count_max_pairs, provider_cmd, len(provider_memory))
-
-			for entry in provider_memory:
-				messages_for_llm.extend(entry['messages'])
-
-			messages_for_llm.append({"role": "user", "content": user_query})
-
-			r = client.chat_completion(
-				provider_config,
-				messages_for_llm,
-				temperature=config["chat_options"]["temperature"]
-			)
-
-			# Store new memory entry
-			new_memory_entry = {
-				'timestamp': time.time(),
-				'user_message_id': user_message_id,
-				'messages': [{"role": "user", "content": user_query}, {"role": "assistant", "content": r}]
-			}
-			provider_memory.append(new_memory_entry)
-			logger.debug('Added new memory entry for %s. Total entries: %d.', provider_cmd, len(provider_memory))
-
-		else: # Memory not enabled
-			messages_for_llm.append({"role": "user", "content": user_query})
-			chat_completion_system_prompt = config["chat_options"].get("system_prompt")
-
-			r = client.chat_completion(
-				provider_config,
-				messages_for_llm,
-				system_prompt=chat_completion_system_prompt,
-				temperature=config["chat_options"]["temperature"]
-			)
-
-		final_response_text = r
-		parse_mode_for_response = 'markdown'
-
-		# Send/Edit final response
-		if bot_reply_id_for_edit:
-			try:
-				await context.bot.edit_message_text(
-					chat_id=chat_id,
-					message_id=bot_reply_id_for_edit,
-					text=final_response_text,
-					parse_mode=parse_mode_for_response
-				)
-				logger.info('Edited bot response for user message ID %s with final content.', user_message_id)
-			except Exception as edit_e:
-				logger.warning('Failed to edit message %s with final response (error: %s). Sending new final response.', bot_reply_id_for_edit, edit_e)
-				new_reply = await message_to_process.reply_text(final_response_text, parse_mode=parse_mode_for_response)
-				context.chat_data['bot_replies'][user_message_id] = new_reply.message_id
-		else:
-			new_reply = await message_to_process.reply_text(final_response_text, parse_mode=parse_mode_for_response)
-			context.chat_data['bot_replies'][user_message_id] = new_reply.message_id
-
-		logger.info('chat() response from %s (cmd: %s): %s', display_name, provider_cmd, r)
-
-	except Exception as e:
-		error_message = f"An error occurred while chatting with {display_name}: {e}"
-		current_bot_reply_id = None
-
-		if bot_reply_id_for_edit:
-			try:
-				edited_message = await context.bot.edit_message_text(
-					chat_id=chat_id,
-					message_id=bot_reply_id_for_edit,
-					text=error_message,
-					parse_mode=None
-				)
-				current_bot_reply_id = edited_message.message_id # Get message_id from the edited message object
-				logger.error('Edited bot response to error for user message ID %s: %s', user_message_id, e)
-			except Exception as edit_e:
-				logger.error('Failed to edit message %s with error (error: %s). Sending new error message.', bot_reply_id_for_edit, edit_e)
-				new_reply = await message_to_process.reply_text(error_message, parse_mode=None)
-				current_bot_reply_id = new_reply.message_id
-		else:
-			new_reply = await message_to_process.reply_text(error_message, parse_mode=None)
-			current_bot_reply_id = new_reply.message_id
-
-		if current_bot_reply_id:
-			context.chat_data['bot_replies'][user_message_id] = current_bot_reply_id
-
-		logger.error('chat() error with provider %s (cmd: %s): %s', display_name, provider_cmd, e)
-
-
-async def id_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-	"""Sends information about the current chat."""
-	logger.info('id_command() update: %s', update)
-	chat_info = update.effective_chat
-
-	if not update.effective_message:
-		logger.warning("ID update without effective message.")
-		return
-
-	# Check for authorization
-	if not is_chat_authorized(update):
-		return # Ignore unauthorized chat
-
-	# Output for /id uses markdown
-	await update.effective_message.reply_text(
-		f"Chat ID: `{chat_info.id}`\n",
-		parse_mode='markdown'
-	)
-
-
-def main() -> None:
-	"""Starts the bot."""
-	application = Application.builder().token(config['misc_options']['bot_token']).build()
-
-	# Register command handlers
-	application.add_handler(CommandHandler("help", help_command))
-	application.add_handler(CommandHandler("id", id_command))
-
-	# Add all providers
-	for provider_config in config['chat_providers']:
-		command_name = provider_config["cmd"]
-		handler_callback = functools.partial(chat, provider_config=provider_config)
-		application.add_handler(CommandHandler(command_name, handler_callback))
-
-	# Unused: Register message handler for non-command text
-	# application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, echo))
-
-	logger.info("Bot started. Press Ctrl-C to stop.")
-	application.run_polling(allowed_updates=Update.ALL_TYPES)
-
-
-if __name__ == '__main__':
-	main()
+#!/usr/bin/env python3
+# Telegram Chatbot https://github.com/dhjw/telegram-chatbot
+import os, logging, orjson, time, asyncio
+from collections import deque, OrderedDict
+from telegram import Update
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, PicklePersistence, PersistenceInput
+from telegram.request import HTTPXRequest
+from inc.chat_completion import ChatCompletionClient
+
+# Enable logging
+logging.basicConfig(
+	format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+	level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# Change current working directory
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+# Load config
+try:
+	with open('./config.json', 'rb') as f:
+		config = orjson.loads(f.read())
+except Exception as e:
+	logger.critical('Error loading config.json: %s', e)
+	quit()
+
+# Hoist config values into module-level constants so the hot path avoids repeated dict lookups
+_CHAT_OPTIONS = config['chat_options']
+_MISC_OPTIONS = config['misc_options']
+MEMORY_ENABLED = bool(_CHAT_OPTIONS.get('memory_enabled', False))
+MEMORY_EXPIRES = _CHAT_OPTIONS.get('memory_expires', 0)
+MEMORY_MAX_PAIRS = _CHAT_OPTIONS.get('memory_max_pairs', 0)
+SYSTEM_PROMPT = _CHAT_OPTIONS.get('system_prompt')
+TEMPERATURE = _CHAT_OPTIONS['temperature']
+# Delay (seconds) before "Please wait..." appears on edited messages; 0 shows it immediately
+SHOW_PLEASE_WAIT_AFTER = _CHAT_OPTIONS.get('show_please_wait_after_ms', 0) / 1000
+WIPE_SUBCMD = _CHAT_OPTIONS.get('memory_wipe_subcmd')
+# memory_wipe_subcmd accepts a single subcommand or a list of aliases; casefold them once
+_WIPE_SUBCMDS = WIPE_SUBCMD if isinstance(WIPE_SUBCMD, list) else ([WIPE_SUBCMD] if WIPE_SUBCMD else [])
+WIPE_ALIASES = tuple(s.casefold() for s in _WIPE_SUBCMDS)
+WIPE_MAX_LEN = max(map(len, WIPE_ALIASES), default=0)
+BOT_TOKEN = _MISC_OPTIONS['bot_token']
+PERSISTENCE_FILE = _MISC_OPTIONS.get('persistence_file') # Empty/absent disables persistence
+ENFORCE_CHAT_IDS = _MISC_OPTIONS.get('enforce_chat_ids', False)
+ALLOWED_CHAT_IDS = frozenset(_MISC_OPTIONS.get('allow_chat_ids', []) or ())
+
+# Build help text once; providers and options are static after startup
+def _build_help_text() -> str:
+	help_text = "Available commands:\n/help\n"
+	wipe_subcmd_display = f" | {' | '.join(_WIPE_SUBCMDS)}" if MEMORY_ENABLED and _WIPE_SUBCMDS else ""
+	for provider_config in config['chat_providers']:
+		help_text += f"/{provider_config['cmd']} <text>{wipe_subcmd_display}\n"
+	return help_text
+
+HELP_TEXT = _build_help_text()
+
+# Provider lookup table for O(1) command dispatch (commands match case-insensitively)
+PROVIDER_BY_CMD = {p['cmd'].lower(): p for p in config['chat_providers']}
+
+# Initialize optional semantic response cache
+semantic_cache = None
+if _CHAT_OPTIONS.get('semantic_cache_enabled', False):
+	try:
+		from inc.semantic_cache import SemanticCache
+		semantic_cache = SemanticCache(threshold=_CHAT_OPTIONS.get('semantic_cache_threshold', 0.92))
+	except Exception as e:
+		logger.warning('Semantic cache disabled (error: %s). Install fastembed and hnswlib to enable it.', e)
+
+# Initialize ChatCompletionClient; it caches responses internally (exact-match for
+# deterministic requests, plus the semantic tier when enabled)
+try:
+	client = ChatCompletionClient(config['chat_providers'], semantic_cache=semantic_cache)
+except Exception as e:
+	logger.critical('Error initializing ChatCompletionClient: %s', e)
+	quit()
+
+
+# Per-chat locks: concurrent_updates lets different chats progress in parallel, while
+# handling within one chat stays serialized so the memory deques, flat views and the
+# client's per-conversation caches are never mutated by two updates at once
+chat_locks = {}
+
+def get_chat_lock(chat_id: int) -> asyncio.Lock:
+	lock = chat_locks.get(chat_id)
+	if lock is None:
+		lock = chat_locks[chat_id] = asyncio.Lock()
+	return lock
+
+
+# Per-chat bot_replies cap; only recent messages matter for edited-message flows
+BOT_REPLIES_MAX = 500
+
+def remember_bot_reply(bot_replies: OrderedDict, user_message_id: int, bot_message_id: int) -> None:
+	"""Records the bot reply for a user message, LRU-evicting past BOT_REPLIES_MAX."""
+	bot_replies[user_message_id] = bot_message_id
+	bot_replies.move_to_end(user_message_id)
+	while len(bot_replies) > BOT_REPLIES_MAX:
+		bot_replies.popitem(last=False)
+
+
+def prune_provider_memory(provider_memory: deque, provider_flat: deque, now: float, edit_id) -> int:
+	"""Prunes expired pairs and any pair for an edited message in one pass.
+
+	Returns the number of pairs removed; max_pairs is enforced by the deque's
+	maxlen on append. The flat message view is rebuilt in lockstep.
+	"""
+	cutoff = now - MEMORY_EXPIRES if MEMORY_EXPIRES > 0 else None
+	# Entries are time-ordered, so an unexpired head means nothing is expired
+	head_expired = cutoff is not None and bool(provider_memory) and provider_memory[0]['timestamp'] < cutoff
+	if not head_expired and edit_id is None:
+		return 0
+	kept_entries = [
+		entry for entry in provider_memory
+		if (cutoff is None or entry['timestamp'] >= cutoff)
+		and (edit_id is None or entry.get('user_message_id') != edit_id)
+	]
+	removed_count = len(provider_memory) - len(kept_entries)
+	if removed_count:
+		provider_memory.clear()
+		provider_memory.extend(kept_entries)
+		provider_flat.clear()
+		for entry in kept_entries:
+			provider_flat.extend(entry['messages'])
+	return removed_count
+
+
+async def await_completion_with_please_wait(completion_task, context, chat_id: int, bot_reply_id_for_edit, is_edited: bool) -> str:
+	"""Awaits a running completion task, updating the previous reply to "Please wait..."
+	for edited messages - but only once the provider has taken SHOW_PLEASE_WAIT_AFTER
+	seconds, so fast responses skip the extra Telegram round trip entirely."""
+	if not (is_edited and bot_reply_id_for_edit):
+		return await completion_task
+
+	if SHOW_PLEASE_WAIT_AFTER > 0:
+		try:
+			return await asyncio.wait_for(asyncio.shield(completion_task), timeout=SHOW_PLEASE_WAIT_AFTER)
+		except asyncio.TimeoutError:
+			pass # Provider is slow; fall through and show the notice
+
+	try:
+		await context.bot.edit_message_text(
+			chat_id=chat_id,
+			message_id=bot_reply_id_for_edit,
+			text="Please wait...",
+			parse_mode=None
+		)
+		logger.info('Edited previous bot response to "Please wait..." (message ID %s)', bot_reply_id_for_edit)
+	except Exception as edit_e:
+		logger.warning('Failed to edit message %s to "Please wait..." (error: %s). Proceeding without update.', bot_reply_id_for_edit, edit_e)
+
+	return await completion_task
+
+
+# Helper for chat ID authorization
+def is_chat_authorized(update: Update) -> bool:
+	# Enforce only if enabled and list not empty; frozenset membership is O(1)
+	if (not ENFORCE_CHAT_IDS) or (not ALLOWED_CHAT_IDS) or (update.effective_chat.id in ALLOWED_CHAT_IDS):
+		return True
+	if logger.isEnabledFor(logging.INFO):
+		logger.info('Ignoring unauthorized chat ID: %s', update.effective_chat.id)
+	return False
+
+
+# Define command handlers
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+	"""Sends a message with available commands."""
+	# str(Update) walks the whole nested object graph - only pay for it at DEBUG
+	if logger.isEnabledFor(logging.DEBUG):
+		logger.debug('help_command() update: %s', update)
+
+	if not is_chat_authorized(update):
+		return # Ignore unauthorized chat
+
+	if update.effective_message:
+		await update.effective_message.reply_text(HELP_TEXT)
+
+
+async def chat(update: Update, context: ContextTypes.DEFAULT_TYPE, provider_config: dict) -> None:
+	"""Handles chat commands for different providers."""
+	if not is_chat_authorized(update):
+		return # Ignore unauthorized chat
+
+	display_name = provider_config.get('name', provider_config['cmd'])
+	provider_cmd = provider_config['cmd'] # Memory key
+
+	# Get message object
+	message_to_process = update.edited_message if update.edited_message else update.message
+
+	if not message_to_process:
+		logger.warning("Chat update without effective message.")
+		return # No reply
+
+	chat_id = message_to_process.chat_id
+	user_message_id = message_to_process.message_id # User's message ID
+
+	# Initialize bot_replies in chat_data, bounded via remember_bot_reply
+	bot_replies = context.chat_data.get('bot_replies')
+	if bot_replies is None:
+		bot_replies = context.chat_data['bot_replies'] = OrderedDict()
+
+	# Get ID of bot's previous reply
+	bot_reply_id_for_edit = bot_replies.get(user_message_id)
+	if bot_reply_id_for_edit is not None:
+		bot_replies.move_to_end(user_message_id)
+
+	# Serialize per chat; other chats' updates are processed concurrently
+	async with get_chat_lock(chat_id):
+		try:
+			# If no arguments, show help text
+			if not context.args:
+				await help_command(update, context)
+				return
+
+			user_query = " ".join(context.args)
+			logger.info('Incoming query for %s (cmd: %s): %s', display_name, provider_cmd, user_query)
+
+			# Handle memory wipe subcommand; user_query comes from " ".join(args) so it has no
+			# leading whitespace - casefold just the prefix slice, then C-level startswith over aliases
+			if WIPE_ALIASES and user_query[:WIPE_MAX_LEN].casefold().startswith(WIPE_ALIASES):
+				if MEMORY_ENABLED:
+					chat_memories = context.chat_data.setdefault('chat_memories', {})
+					if provider_cmd in chat_memories:
+						wiped_count = len(chat_memories[provider_cmd])
+						chat_memories[provider_cmd].clear()
+						flat_key = f'{provider_cmd}_flat'
+						if flat_key in chat_memories:
+							chat_memories[flat_key].clear()
+						logger.info('Memory for provider %s wiped. %d pairs removed.', provider_cmd, wiped_count)
+
+					response_content = "Memory erased."
+				else:
+					response_content = "Memory is not enabled."
+
+				# Send/Edit "Memory erased." message
+				if bot_reply_id_for_edit:
+					try:
+						await context.bot.edit_message_text(
+							chat_id=chat_id,
+							message_id=bot_reply_id_for_edit,
+							text=response_content,
+							parse_mode=None
+						)
+					except Exception as edit_e:
+						logger.warning('Failed to edit message %s with "Memory erased." (error: %s). Sending new message.', bot_reply_id_for_edit, edit_e)
+						await message_to_process.reply_text(response_content, parse_mode=None)
+				else:
+					new_reply = await message_to_process.reply_text(response_content, parse_mode=None)
+					remember_bot_reply(bot_replies, user_message_id, new_reply.message_id)
+				return # Exit after memory wipe
+
+			# Prepare messages for LLM, including memory
+			messages_for_llm = []
+			chat_completion_system_prompt = None
+
+			if MEMORY_ENABLED:
+				chat_memories = context.chat_data.setdefault('chat_memories', {})
+				# deque(maxlen=...) drops the oldest pair automatically on append, so no explicit max_pairs trimming
+				provider_memory = chat_memories.setdefault(provider_cmd, deque(maxlen=MEMORY_MAX_PAIRS or None))
+				# Flat view of provider_memory's messages, mutated in lockstep (two messages per pair),
+				# so each turn copies it instead of re-walking every entry
+				provider_flat = chat_memories.setdefault(f'{provider_cmd}_flat', deque())
+
+				# One timestamp per turn; reused for expiry checks and the new memory entry
+				now = time.time()
+
+				# Drop expired pairs and, for edited messages, the stale pair in a single pass
+				edit_id = update.edited_message.message_id if update.edited_message else None
+				removed_count = prune_provider_memory(provider_memory, provider_flat, now, edit_id)
+				if removed_count > 0:
+					logger.debug('Removed %d expired/edited memory pair(s) for %s. Remaining: %d.', removed_count, provider_cmd, len(provider_memory))
+
+				if SYSTEM_PROMPT:
+					messages_for_llm.append({"role": "system", "content": SYSTEM_PROMPT})
+				messages_for_llm.extend(provider_flat)
+				messages_for_llm.append({"role": "user", "content": user_query})
+
+				# The async client keeps the event loop servicing updates during the round trip;
+				# the "Please wait..." notice (edited messages) overlaps the call
+				completion_task = asyncio.create_task(client.achat_completion(
+					provider_config,
+					messages_for_llm,
+					temperature=TEMPERATURE,
+					conversation_id=str(chat_id), # Reuse the per-chat formatted-message cache
+					session_id=str(chat_id) # Sticky routing for server-side prefix caches
+				))
+				r = await await_completion_with_please_wait(completion_task, context, chat_id, bot_reply_id_for_edit, update.edited_message is not None)
+
+				# Store new memory entry
+				new_memory_entry = {
+					'timestamp': now,
+					'user_message_id': user_message_id,
+					'messages': [{"role": "user", "content": user_query}, {"role": "assistant", "content": r}]
+				}
+				# Appending to a full deque drops the head pair; mirror that in the flat view first
+				if provider_memory.maxlen is not None and len(provider_memory) == provider_memory.maxlen:
+					provider_flat.popleft()
+					provider_flat.popleft()
+				provider_memory.append(new_memory_entry)
+				provider_flat.extend(new_memory_entry['messages'])
+				logger.debug('Added new memory entry for %s. Total entries: %d.', provider_cmd, len(provider_memory))
+
+			else: # Memory not enabled
+				messages_for_llm.append({"role": "user", "content": user_query})
+				chat_completion_system_prompt = SYSTEM_PROMPT
+
+				completion_task = asyncio.create_task(client.achat_completion(
+					provider_config,
+					messages_for_llm,
+					system_prompt=chat_completion_system_prompt,
+					temperature=TEMPERATURE,
+					session_id=str(chat_id) # Sticky routing for server-side prefix caches
+				))
+				r = await await_completion_with_please_wait(completion_task, context, chat_id, bot_reply_id_for_edit, update.edited_message is not None)
+
+			final_response_text = r
+			parse_mode_for_response = 'markdown'
+
+			# Send/Edit final response
+			if bot_reply_id_for_edit:
+				try:
+					await context.bot.edit_message_text(
+						chat_id=chat_id,
+						message_id=bot_reply_id_for_edit,
+						text=final_response_text,
+						parse_mode=parse_mode_for_response
+					)
+					logger.info('Edited bot response for user message ID %s with final content.', user_message_id)
+				except Exception as edit_e:
+					logger.warning('Failed to edit message %s with final response (error: %s). Sending new final response.', bot_reply_id_for_edit, edit_e)
+					new_reply = await message_to_process.reply_text(final_response_text, parse_mode=parse_mode_for_response)
+					remember_bot_reply(bot_replies, user_message_id, new_reply.message_id)
+			else:
+				new_reply = await message_to_process.reply_text(final_response_text, parse_mode=parse_mode_for_response)
+				remember_bot_reply(bot_replies, user_message_id, new_reply.message_id)
+
+			logger.info('chat() response from %s (cmd: %s): %s', display_name, provider_cmd, r)
+
+		except Exception as e:
+			error_message = f"An error occurred while chatting with {display_name}: {e}"
+			current_bot_reply_id = None
+
+			if bot_reply_id_for_edit:
+				try:
+					edited_message = await context.bot.edit_message_text(
+						chat_id=chat_id,
+						message_id=bot_reply_id_for_edit,
+						text=error_message,
+						parse_mode=None
+					)
+					current_bot_reply_id = edited_message.message_id # Get message_id from the edited message object
+					logger.error('Edited bot response to error for user message ID %s: %s', user_message_id, e)
+				except Exception as edit_e:
+					logger.error('Failed to edit message %s with error (error: %s). Sending new error message.', bot_reply_id_for_edit, edit_e)
+					new_reply = await message_to_process.reply_text(error_message, parse_mode=None)
+					current_bot_reply_id = new_reply.message_id
+			else:
+				new_reply = await message_to_process.reply_text(error_message, parse_mode=None)
+				current_bot_reply_id = new_reply.message_id
+
+			if current_bot_reply_id:
+				remember_bot_reply(bot_replies, user_message_id, current_bot_reply_id)
+
+			logger.error('chat() error with provider %s (cmd: %s): %s', display_name, provider_cmd, e)
+
+
+async def dispatch_provider_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+	"""Routes provider commands to chat() via a single dict lookup."""
+	message = update.effective_message
+	if not message or not message.text:
+		return
+
+	# split() handles any whitespace after the command (e.g. "/gpt\nhello"), like CommandHandler
+	command, _, mention = message.text.split(maxsplit=1)[0][1:].partition('@')
+	provider_config = PROVIDER_BY_CMD.get(command.lower())
+	if provider_config is None:
+		return # Not a provider command
+
+	if mention and mention.lower() != context.bot.username.lower():
+		return # Addressed to another bot
+
+	context.args = message.text.split()[1:] # MessageHandler doesn't populate args like CommandHandler
+	await chat(update, context, provider_config)
+
+
+async def id_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+	"""Sends information about the current chat."""
+	if logger.isEnabledFor(logging.DEBUG):
+		logger.debug('id_command() update: %s', update)
+	chat_info = update.effective_chat
+
+	if not update.effective_message:
+		logger.warning("ID update without effective message.")
+		return
+
+	# Check for authorization
+	if not is_chat_authorized(update):
+		return # Ignore unauthorized chat
+
+	# Output for /id uses markdown
+	await update.effective_message.reply_text(
+		f"Chat ID: `{chat_info.id}`\n",
+		parse_mode='markdown'
+	)
+
+
+async def post_init(application: Application) -> None:
+	"""Pre-warms provider connections once the event loop is up; failures are harmless."""
+	await client.prewarm()
+
+
+def main() -> None:
+	"""Starts the bot."""
+	# Pooled HTTP/2 connections so the reply/edit calls reuse TLS sessions; getUpdates
+	# gets its own small pool with a read timeout above the long-poll timeout
+	request = HTTPXRequest(connection_pool_size=64, http_version='2', read_timeout=30, connect_timeout=10)
+	get_updates_request = HTTPXRequest(connection_pool_size=8, http_version='2', read_timeout=35)
+	# Without concurrent_updates PTB awaits each handler before fetching the next update,
+	# so one slow LLM call would stall every chat; per-chat locks keep ordering within a chat
+	builder = Application.builder().token(BOT_TOKEN).concurrent_updates(True).request(request).get_updates_request(get_updates_request).post_init(post_init)
+
+	# Optional on-disk persistence of chat_data (memories + bot_replies survive restarts).
+	# Only chat_data is stored and writes are batched so we don't pickle on every update.
+	if PERSISTENCE_FILE:
+		builder = builder.persistence(PicklePersistence(
+			filepath=PERSISTENCE_FILE,
+			store_data=PersistenceInput(chat_data=True, bot_data=False, user_data=False, callback_data=False),
+			update_interval=60
+		))
+
+	application = builder.build()
+
+	# Register command handlers
+	application.add_handler(CommandHandler("help", help_command))
+	application.add_handler(CommandHandler("id", id_command))
+
+	# One handler dispatches all provider commands instead of one CommandHandler per provider,
+	# so PTB probes a single handler per update regardless of provider count
+	application.add_handler(MessageHandler(filters.COMMAND, dispatch_provider_command))
+
+	# Unused: Register message handler for non-command text
+	# application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, echo))
+
+	logger.info("Bot started. Press Ctrl-C to stop.")
+	# Long-poll at Telegram's ~30s ceiling and only ask for the update types we handle,
+	# so idle polling does far fewer round trips with smaller payloads
+	application.run_polling(
+		poll_interval=0.0,
+		timeout=30,
+		drop_pending_updates=True,
+		allowed_updates=[Update.MESSAGE, Update.EDITED_MESSAGE]
+	)
+
+
+if __name__ == '__main__':
+	main()
@@ -1,172 +1,898 @@
-import os
-import json
-import logging
-from typing import List, Dict, Literal, Optional, Any, Union
-
-from openai import OpenAI
-import google.generativeai as genai
-
-logger = logging.getLogger(__name__)
-
-class ChatCompletionError(Exception):
-	"""Custom exception for chat completion errors."""
-	pass
-
-class ChatCompletionClient:
-	"""Unified client for chat completion (OpenAI-compatible, or Gemini)."""
-
-	def __init__(
-			self,
-			provider_configs_list: List[Dict[str, Any]]
-	):
-		"""
-		Initializes client with provider configurations.
-		Args:
-		   provider_configs_list: List of provider config dicts.
-		"""
-		if not provider_configs_list:
-			raise ValueError("Provider configs list cannot be empty.")
-
-		# Create internal dict keyed by 'cmd'
-		self.provider_configs_by_cmd: Dict[str, Dict[str, Any]] = {
-			p['cmd']: p for p in provider_configs_list if 'cmd' in p
-		}
-		if not self.provider_configs_by_cmd:
-			raise ValueError("No valid provider configurations found with 'cmd' keys.")
-
-		self.openai_clients: Dict[str, OpenAI] = {}
-		self.gemini_native_clients: Dict[str, genai.GenerativeModel] = {}
-
-		self._initialize_clients()
-
-	def _initialize_clients(self):
-		"""Initializes API clients."""
-		for cmd, config in self.provider_configs_by_cmd.items():
-			identifier = cmd
-			display_name = config.get("name", cmd)
-
-			is_gemini = config.get("is_gemini", False)
-			api_key = config.get("api_key")
-			model = config.get("model")
-			base_url = config.get("base_url")
-
-			if not api_key:
-				logger.warning(f"API key missing for '{display_name}' (cmd: '{identifier}'). Skipping.")
-				continue
-			if not model:
-				logger.warning(f"Default model missing for '{display_name}' (cmd: '{identifier}'). Skipping.")
-				continue
-
-			try:
-				if is_gemini:
-					genai.configure(api_key=api_key)
-					self.gemini_native_clients[identifier] = genai.GenerativeModel(model_name=model)
-					logger.info(f"Gemini client '{display_name}' (cmd: '{identifier}') initialized.")
-				else:
-					if not base_url:
-						logger.warning(f"Base URL missing for OpenAI-compatible client '{display_name}' (cmd: '{identifier}'). Skipping.")
-						continue
-
-					client_kwargs = {"api_key": api_key, "base_url": base_url}
-					self.openai_clients[identifier] = OpenAI(**client_kwargs)
-					logger.info(f"OpenAI-compatible client '{display_name}' (cmd: '{identifier}') initialized.")
-			except Exception as e:
-				logger.error(f"Error initializing client '{display_name}' (cmd: '{identifier}'): {e}")
-
-	def _get_openai_client(self, provider_cmd: str) -> OpenAI:
-		"""Retrieves an initialized OpenAI-compatible client."""
-		client = self.openai_clients.get(provider_cmd)
-		if not client:
-			raise ChatCompletionError(
-				f"OpenAI-compatible client '{provider_cmd}' not initialized. Check config."
-			)
-		return client
-
-	def chat_completion(self,
-						provider_config: Dict[str, Any],
-						messages: List[Dict[str, str]],
-						system_prompt: Optional[str] = None,
-						temperature: float = 0.7,
-						max_tokens: Optional[int] = None,
-						**kwargs) -> str:
-		"""
-		Performs a chat completion request.
-		Args:
-		   provider_config: Config dict for the LLM provider.
-		   messages: List of message dicts.
-		   system_prompt: Optional system behavior/context.
-		   temperature: Controls randomness.
-		   max_tokens: Max tokens to generate.
-		   **kwargs: Additional API arguments.
-		Returns:
-		   Content of the generated message.
-		Raises:
-		   ChatCompletionError: If client not initialized or API call fails.
-		   ValueError: If provider config invalid.
-		"""
-		provider_cmd = provider_config.get("cmd")
-		if not provider_cmd:
-			raise ValueError("Provider config missing 'cmd' field.")
-
-		display_name = provider_config.get("name", provider_cmd)
-
-		is_gemini = provider_config.get("is_gemini", False)
-		model = provider_config.get("model")
-
-		if not model:
-			raise ChatCompletionError(f"No model found in config for provider '{display_name}' (cmd: '{provider_cmd}').")
-
-		if not is_gemini: # OpenAI-compatible
-			openai_client = self._get_openai_client(provider_cmd)
-
-			openai_messages = []
-			if system_prompt:
-				openai_messages.append({"role": "system", "content": system_prompt})
-			openai_messages.extend(messages)
-
-			try:
-				response = openai_client.chat.completions.create(
-					model=model,
-					messages=openai_messages,
-					temperature=temperature,
-					max_tokens=max_tokens,
-					stream=False,
-					**kwargs
-				)
-				return response.choices[0].message.content
-			except Exception as e:
-				raise ChatCompletionError(f"OpenAI-compatible chat completion for '{display_name}' (cmd: '{provider_cmd}') failed: {e}")
-
-		else: # Gemini
-			if provider_cmd not in self.gemini_native_clients:
-				raise ChatCompletionError(
-					f"Gemini client '{display_name}' (cmd: '{provider_cmd}') not initialized. Check 'api_key'."
-				)
-
-			gemini_model_instance = self.gemini_native_clients[provider_cmd]
-
-			gemini_messages = []
-			if system_prompt:
-				gemini_messages.append({'role': 'user', 'parts': [system_prompt]})
-
-			for msg in messages:
-				role = 'user' if msg['role'] == 'user' else 'model'
-				gemini_messages.append({'role': role, 'parts': [msg['content']]})
-
-			try:
-				response = gemini_model_instance.generate_content(
-					contents=gemini_messages,
-					generation_config=genai.types.GenerationConfig(
-						temperature=temperature,
-						max_output_tokens=max_tokens
-					),
-					stream=False,
-					**kwargs
-				)
-				if response.candidates:
-					return response.candidates[0].content.parts[0].text
-				else:
-					logger.warning(f"Gemini response for '{display_name}' (cmd: '{provider_cmd}') had no candidates. Possibly blocked or empty response.")
-					return ""
-			except Exception as e:
-				raise ChatCompletionError(f"Gemini chat completion for '{display_name}' (cmd: '{provider_cmd}') failed: {e}")
+import asyncio
+import hashlib
+import io
+import logging
+import random
+from dataclasses import dataclass
+from typing import List, Dict, Literal, Mapping, Optional, Any, Tuple, Union
+
+import cachetools
+import httpx
+import orjson
+import openai
+from openai import AsyncOpenAI
+import google.generativeai as genai
+
+logger = logging.getLogger(__name__)
+
+def _patch_httpx_json_encoder() -> None:
+	"""Routes httpx request-body JSON encoding through orjson (3-10x faster than
+	stdlib json on the dict/str-heavy chat payloads the OpenAI SDK sends), which
+	matters for long histories. Best-effort: if httpx internals change, keep the
+	stdlib encoder."""
+	try:
+		import httpx._content as _httpx_content
+
+		def _orjson_dumps(obj, **_kwargs) -> str:
+			# httpx encodes the returned str itself; compact separators match orjson's output
+			return orjson.dumps(obj).decode('utf-8')
+
+		_httpx_content.json_dumps = _orjson_dumps
+		logger.debug('httpx JSON encoding routed through orjson.')
+	except Exception as e:
+		logger.debug('Could not patch httpx JSON encoder, keeping stdlib json: %s', e)
+
+_patch_httpx_json_encoder()
+
+# Telegram/OpenAI role -> Gemini role; dict lookup beats a conditional per message
+_TO_GEMINI_ROLE = {'user': 'user', 'assistant': 'model', 'system': 'user', 'model': 'model'}
+
+_RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+def _is_retryable_error(e: Exception) -> bool:
+	"""True for rate-limit and transient server errors worth retrying."""
+	if isinstance(e, openai.RateLimitError):
+		return True
+	status = getattr(e, 'status_code', None) # openai.APIStatusError
+	if status is None:
+		status = getattr(e, 'code', None) # google.api_core exceptions
+	return status in _RETRYABLE_STATUS_CODES
+
+class ChatCompletionError(Exception):
+	"""Custom exception for chat completion errors."""
+	pass
+
+@dataclass(slots=True, frozen=True)
+class ProviderInfo:
+	"""Validated provider row built once at init, so the request path reads
+	attributes instead of chasing dict lookups and defaults."""
+	cmd: str
+	name: str
+	is_gemini: bool
+	model: str
+	max_retries: int = 2
+	supports_cache_salt: bool = False
+	supports_prompt_list: bool = False
+
+class ChatCompletionClient:
+	"""Unified client for chat completion (OpenAI-compatible, or Gemini)."""
+
+	def __init__(
+			self,
+			provider_configs_list: List[Dict[str, Any]],
+			max_connections: int = 2000,
+			max_keepalive_connections: int = 1500,
+			timeout: float = 60.0,
+			cache_maxsize: int = 10_000,
+			semantic_cache=None
+	):
+		"""
+		Initializes client with provider configurations.
+		Args:
+		   provider_configs_list: List of provider config dicts.
+		   max_connections: Connection ceiling for the shared async HTTP client.
+		   max_keepalive_connections: Kept-alive connections in the shared pool.
+		   timeout: Default HTTP timeout in seconds.
+		   cache_maxsize: Entries in the exact-match response cache.
+		   semantic_cache: Optional inc.semantic_cache.SemanticCache for near-
+		      duplicate single-message prompts.
+		"""
+		if not provider_configs_list:
+			raise ValueError("Provider configs list cannot be empty.")
+
+		# One shared pool for every async OpenAI-compatible endpoint: the SDK's default
+		# client caps out at 100 connections and doesn't share kept-alive TLS sessions
+		self._http = httpx.AsyncClient(
+			limits=httpx.Limits(
+				max_connections=max_connections,
+				max_keepalive_connections=max_keepalive_connections
+			),
+			timeout=timeout
+		)
+		# Also the default per-request timeout so a hung provider can't wedge a task
+		self.default_timeout = timeout
+
+		# Create internal dict keyed by 'cmd'
+		self.provider_configs_by_cmd: Dict[str, Dict[str, Any]] = {
+			p['cmd']: p for p in provider_configs_list if 'cmd' in p
+		}
+		if not self.provider_configs_by_cmd:
+			raise ValueError("No valid provider configurations found with 'cmd' keys.")
+
+		# One client per configured endpoint; calls round-robin across them. The sync
+		# chat_completion wrapper also goes through these via asyncio.run.
+		self.async_openai_clients: Dict[str, List[AsyncOpenAI]] = {}
+		self.gemini_native_clients: Dict[str, genai.GenerativeModel] = {}
+		self._semaphores: Dict[str, asyncio.Semaphore] = {}
+		self._rr: Dict[str, int] = {} # Per-cmd round-robin counters
+		self._configured_gemini_keys: set = set()
+		self.providers: Dict[str, ProviderInfo] = {}
+
+		# Two-tier response cache: exact-match LRU for deterministic requests, plus an
+		# optional embedding-similarity tier for single-message prompts
+		self._exact_cache = cachetools.LRUCache(maxsize=cache_maxsize)
+		self._semantic_cache = semantic_cache
+
+		# Per-conversation formatted-message cache; chat history is append-only, so each
+		# call only needs to translate the new tail (see _format_gemini_messages)
+		self._conv_cache = cachetools.LRUCache(maxsize=256)
+
+		# In-flight speculative completions by session id (see prefetch)
+		self._prefetches: Dict[str, Tuple[bytes, asyncio.Task]] = {}
+
+		# Priority-queue traffic shaping for providers configured with 'workers'
+		self._queues: Dict[str, asyncio.PriorityQueue] = {}
+		self._worker_tasks: List[asyncio.Task] = [] # Strong refs; the loop only keeps weak ones
+		self._job_seq = 0 # FIFO tie-breaker within a priority level
+
+		self._initialize_clients()
+
+	def _initialize_clients(self):
+		"""Initializes API clients."""
+		for cmd, config in self.provider_configs_by_cmd.items():
+			identifier = cmd
+			display_name = config.get("name", cmd)
+
+			is_gemini = config.get("is_gemini", False)
+			api_key = config.get("api_key")
+			model = config.get("model")
+			base_url = config.get("base_url")
+
+			if not api_key and not config.get("api_keys"):
+				logger.warning(f"API key missing for '{display_name}' (cmd: '{identifier}'). Skipping.")
+				continue
+			if not model:
+				logger.warning(f"Default model missing for '{display_name}' (cmd: '{identifier}'). Skipping.")
+				continue
+
+			# Cap concurrent in-flight requests per provider (config 'max_concurrent')
+			self._semaphores[identifier] = asyncio.Semaphore(config.get("max_concurrent", 8))
+
+			try:
+				if is_gemini:
+					# genai.configure mutates process-global SDK state; do it once per key,
+					# at init only - never on the request path
+					if api_key not in self._configured_gemini_keys:
+						genai.configure(api_key=api_key)
+						self._configured_gemini_keys.add(api_key)
+					self.gemini_native_clients[identifier] = genai.GenerativeModel(model_name=model)
+					logger.info(f"Gemini client '{display_name}' (cmd: '{identifier}') initialized.")
+				else:
+					if not base_url and not config.get("base_urls"):
+						logger.warning(f"Base URL missing for OpenAI-compatible client '{display_name}' (cmd: '{identifier}'). Skipping.")
+						continue
+
+					# Providers may list several api_keys/base_urls (extra keys/regions for the
+					# same model family); a lone key or URL is broadcast across the other list
+					api_keys = config.get("api_keys") or [api_key]
+					base_urls = config.get("base_urls") or [base_url]
+					if len(api_keys) == 1 and len(base_urls) > 1:
+						api_keys = api_keys * len(base_urls)
+					if len(base_urls) == 1 and len(api_keys) > 1:
+						base_urls = base_urls * len(api_keys)
+
+					async_clients = []
+					for endpoint_key, endpoint_url in zip(api_keys, base_urls):
+						async_clients.append(AsyncOpenAI(http_client=self._http, api_key=endpoint_key, base_url=endpoint_url))
+					self.async_openai_clients[identifier] = async_clients
+					logger.info(f"OpenAI-compatible client '{display_name}' (cmd: '{identifier}') initialized with {len(async_clients)} endpoint(s).")
+
+				self.providers[identifier] = ProviderInfo(
+					cmd=identifier,
+					name=display_name,
+					is_gemini=is_gemini,
+					model=model,
+					max_retries=config.get("max_retries", 2),
+					supports_cache_salt=config.get("supports_cache_salt", False),
+					supports_prompt_list=config.get("supports_prompt_list", False)
+				)
+			except Exception as e:
+				logger.error(f"Error initializing client '{display_name}' (cmd: '{identifier}'): {e}")
+
+	def _resolve_provider(self, provider: Union[str, Dict[str, Any], ProviderInfo]) -> ProviderInfo:
+		"""Maps a cmd string, legacy config dict, or ProviderInfo to the validated
+		provider row, so hot-path code works with attribute reads only."""
+		if isinstance(provider, ProviderInfo):
+			return provider
+		if isinstance(provider, str):
+			info = self.providers.get(provider)
+			if not info:
+				raise ChatCompletionError(f"Provider '{provider}' not initialized. Check config.")
+			return info
+
+		provider_cmd = provider.get("cmd")
+		if not provider_cmd:
+			raise ValueError("Provider config missing 'cmd' field.")
+		info = self.providers.get(provider_cmd)
+		if info is not None:
+			return info
+		# Uninitialized provider passed as a dict: build an ad-hoc row so the error
+		# surfaces from the client lookup with the usual message
+		display_name = provider.get("name", provider_cmd)
+		model = provider.get("model")
+		if not model:
+			raise ChatCompletionError(f"No model found in config for provider '{display_name}' (cmd: '{provider_cmd}').")
+		return ProviderInfo(
+			cmd=provider_cmd,
+			name=display_name,
+			is_gemini=provider.get("is_gemini", False),
+			model=model,
+			max_retries=provider.get("max_retries", 2),
+			supports_cache_salt=provider.get("supports_cache_salt", False),
+			supports_prompt_list=provider.get("supports_prompt_list", False)
+		)
+
+	def _ensure_workers(self, provider: ProviderInfo) -> Optional[asyncio.PriorityQueue]:
+		"""Returns the provider's job queue, starting its worker tasks on first use.
+		None when the provider doesn't configure 'workers'."""
+		workers = self.provider_configs_by_cmd.get(provider.cmd, {}).get("workers", 0)
+		if not workers:
+			return None
+		queue = self._queues.get(provider.cmd)
+		if queue is None:
+			queue = self._queues[provider.cmd] = asyncio.PriorityQueue()
+			for _ in range(workers):
+				# Keep a strong reference: a bare create_task result can be garbage-
+				# collected mid-run, silently killing the worker and hanging its jobs
+				self._worker_tasks.append(asyncio.create_task(self._worker(queue)))
+			logger.info(f"Started {workers} worker(s) for provider '{provider.cmd}'.")
+		return queue
+
+	async def _worker(self, queue: asyncio.PriorityQueue) -> None:
+		"""Pulls (priority, seq, future, job) entries and completes them in order,
+		so low-priority background jobs can't starve interactive traffic."""
+		while True:
+			_priority, _seq, future, job = await queue.get()
+			if not future.cancelled():
+				try:
+					result = await self._achat_completion_uncached(**job)
+				except Exception as e:
+					# The caller may have been cancelled while the call ran; setting a
+					# result/exception on a cancelled future would kill this worker
+					if not future.cancelled():
+						future.set_exception(e)
+				else:
+					if not future.cancelled():
+						future.set_result(result)
+			queue.task_done()
+
+	@staticmethod
+	def _prefetch_key(messages: List[Dict[str, str]]) -> bytes:
+		return hashlib.blake2b(orjson.dumps(messages), digest_size=16).digest()
+
+	def prefetch(self, session_id: str, provider_config, messages: List[Dict[str, str]], **kwargs) -> None:
+		"""Speculatively starts a completion for a prompt the caller expects to
+		submit (e.g. while the user is still typing), hiding provider latency
+		behind think-time. A newer prefetch for the same session cancels the
+		older one; the result is consumed by the next achat_completion whose
+		session_id and messages match."""
+		stale = self._prefetches.pop(session_id, None)
+		if stale is not None:
+			stale[1].cancel()
+		task = asyncio.create_task(self.achat_completion(provider_config, messages, **kwargs))
+		self._prefetches[session_id] = (self._prefetch_key(messages), task)
+
+	async def _take_prefetch(self, session_id: str, messages: List[Dict[str, str]]) -> Optional[str]:
+		"""Returns the prefetched result if it matches these messages, else None.
+		A mismatched or failed prefetch is discarded and the caller falls through
+		to a normal request."""
+		entry = self._prefetches.pop(session_id, None)
+		if entry is None:
+			return None
+		key, task = entry
+		if key != self._prefetch_key(messages):
+			task.cancel()
+			return None
+		try:
+			# shield: cancelling *us* must not read as the prefetch's own cancellation
+			return await asyncio.shield(task)
+		except asyncio.CancelledError:
+			if task.cancelled():
+				return None # The prefetch itself was cancelled; fall through to a fresh request
+			task.cancel() # We're being cancelled; don't leave the prefetch running orphaned
+			raise # Propagate our cancellation instead of firing a fresh request
+		except Exception:
+			return None
+
+	async def close(self) -> None:
+		"""Stops the worker tasks and closes the shared HTTP connection pool."""
+		for task in self._worker_tasks:
+			task.cancel()
+		self._worker_tasks.clear()
+		await self._http.aclose()
+
+	async def prewarm(self) -> None:
+		"""Pre-warms connections by issuing a HEAD to each endpoint, so the first user
+		request doesn't pay the TCP+TLS handshake. Failures only log at DEBUG."""
+		base_urls = {str(client.base_url) for clients in self.async_openai_clients.values() for client in clients}
+
+		async def _head(url: str) -> None:
+			try:
+				await self._http.head(url)
+				logger.debug(f"Pre-warmed connection to {url}")
+			except Exception as e:
+				logger.debug(f"Connection pre-warm for {url} failed: {e}")
+
+		await asyncio.gather(*(_head(url) for url in base_urls))
+
+	def _next_endpoint(self, provider_cmd: str, clients_len: int) -> int:
+		"""Advances the provider's round-robin counter and returns the endpoint index."""
+		i = self._rr.get(provider_cmd, 0)
+		self._rr[provider_cmd] = i + 1
+		return i % clients_len
+
+	def _get_async_openai_client(self, provider_cmd: str) -> AsyncOpenAI:
+		"""Retrieves an initialized async OpenAI-compatible client, rotating across endpoints."""
+		clients = self.async_openai_clients.get(provider_cmd)
+		if not clients:
+			raise ChatCompletionError(
+				f"OpenAI-compatible client '{provider_cmd}' not initialized. Check config."
+			)
+		return clients[self._next_endpoint(provider_cmd, len(clients))]
+
+	def _get_batch_client(self, provider_cmd: str) -> AsyncOpenAI:
+		"""Retrieves the provider's first endpoint client, without round-robin.
+		Batches and their files are account-scoped, so submit and poll must go
+		through the same endpoint/key even on multi-endpoint providers."""
+		clients = self.async_openai_clients.get(provider_cmd)
+		if not clients:
+			raise ChatCompletionError(
+				f"OpenAI-compatible client '{provider_cmd}' not initialized. Check config."
+			)
+		return clients[0]
+
+	def _format_gemini_messages(self,
+						provider_cmd: str,
+						messages: List[Dict[str, str]],
+						system_prompt: Optional[str],
+						conversation_id: Optional[str] = None) -> List[Dict[str, Any]]:
+		"""Translates messages into Gemini format. With a conversation_id, the
+		translation is cached per conversation and only the new tail is converted
+		each call - histories are append-only apart from prunes, which show up as
+		a shorter list and trigger a rebuild."""
+		# Tuple parts: immutable, one small allocation each, and the SDK accepts any iterable
+		prefix = [{'role': 'user', 'parts': (system_prompt,)}] if system_prompt else []
+
+		if conversation_id is None:
+			return prefix + [{'role': _TO_GEMINI_ROLE.get(m['role'], 'model'), 'parts': (m['content'],)} for m in messages]
+
+		cache_key = (provider_cmd, conversation_id)
+		cached = self._conv_cache.get(cache_key)
+		if cached is None or len(cached) > len(messages) or (
+			# A prune plus an append can leave the length unchanged while shifting
+			# content; verify the cached boundary entries still line up
+			cached and (cached[0]['parts'][0] != messages[0]['content']
+				or cached[-1]['parts'][0] != messages[len(cached) - 1]['content'])
+		):
+			cached = []
+			self._conv_cache[cache_key] = cached
+		cached.extend(
+			{'role': _TO_GEMINI_ROLE.get(m['role'], 'model'), 'parts': (m['content'],)}
+			for m in messages[len(cached):]
+		)
+		return prefix + cached
+
+	async def _failover_completion(self,
+						configs: List[Dict[str, Any]],
+						call_kwargs: Dict[str, Any],
+						hedge_after_ms: Optional[float]) -> str:
+		"""Tries providers in order, failing over on ChatCompletionError. With
+		hedge_after_ms set, a primary that hasn't answered in time races a hedged
+		request to the next provider and the first success wins."""
+		if hedge_after_ms and len(configs) > 1:
+			primary = asyncio.create_task(self.achat_completion(configs[0], **call_kwargs))
+			try:
+				return await asyncio.wait_for(asyncio.shield(primary), timeout=hedge_after_ms / 1000)
+			except asyncio.TimeoutError:
+				logger.warning('Primary provider slow (> %sms); hedging to the next provider.', hedge_after_ms)
+			except ChatCompletionError as e:
+				logger.warning('Primary provider failed (%s); failing over.', e)
+				primary = None
+
+			hedge = asyncio.create_task(self._failover_completion(configs[1:], call_kwargs, hedge_after_ms))
+			racers = {task for task in (primary, hedge) if task is not None}
+			last_error = None
+			while racers:
+				done, racers = await asyncio.wait(racers, return_when=asyncio.FIRST_COMPLETED)
+				for task in done:
+					if task.exception() is None:
+						for loser in racers:
+							loser.cancel()
+						return task.result()
+					last_error = task.exception()
+			raise last_error
+
+		last_error = None
+		for i, cfg in enumerate(configs):
+			try:
+				return await self.achat_completion(cfg, **call_kwargs)
+			except ChatCompletionError as e:
+				last_error = e
+				if i < len(configs) - 1:
+					logger.warning('Provider failed (%s); failing over to the next provider.', e)
+		raise last_error
+
+	async def achat_completion(self,
+						provider_config: Union[Dict[str, Any], List[Dict[str, Any]]],
+						messages: List[Dict[str, str]],
+						system_prompt: Optional[str] = None,
+						temperature: float = 0.7,
+						max_tokens: Optional[int] = None,
+						conversation_id: Optional[str] = None,
+						session_id: Optional[str] = None,
+						priority: int = 0,
+						hedge_after_ms: Optional[float] = None,
+						timeout: Optional[float] = None,
+						extra: Optional[Mapping[str, Any]] = None,
+						**kwargs) -> str:
+		"""
+		Performs an async chat completion request. Multiple in-flight requests
+		overlap on one event loop instead of blocking a thread each. Responses
+		are served from the exact-match cache for deterministic (temperature 0)
+		repeats, or from the semantic cache for near-duplicate single prompts.
+		Args:
+		   provider_config: Config dict for the LLM provider, or a list of
+		      config dicts tried in order - failures (and, with hedge_after_ms,
+		      slow responses) fail over to the next provider invisibly.
+		   messages: List of message dicts.
+		   system_prompt: Optional system behavior/context.
+		   temperature: Controls randomness.
+		   max_tokens: Max tokens to generate.
+		   conversation_id: Optional stable id enabling the per-conversation
+		      formatted-message cache.
+		   session_id: Optional stable id sent as 'user' (and 'cache_salt' when
+		      the provider sets supports_cache_salt) so prefix-cache-aware
+		      routers keep a conversation on the same replica. Messages are
+		      always ordered [system, *history], so prefixes stay byte-identical
+		      across turns.
+		   priority: Queue priority (lower runs first; 0 = interactive) for
+		      providers configured with 'workers'; ignored otherwise.
+		   hedge_after_ms: With a provider list, fire a hedged request to the
+		      next provider when the primary hasn't answered within this delay.
+		   timeout: Per-request timeout in seconds; defaults to the client-wide
+		      default_timeout so a hung provider can't hold a slot forever.
+		   extra: Additional API arguments, merged into the request once.
+		   **kwargs: Legacy spelling of extra; folded into it up front.
+		Returns:
+		   Content of the generated message.
+		Raises:
+		   ChatCompletionError: If client not initialized or API call fails.
+		   ValueError: If provider config invalid.
+		"""
+		if kwargs:
+			# Fold legacy **kwargs into extra once, so the request path below builds a
+			# single args dict instead of re-spreading kwargs on every attempt
+			extra = {**(extra or {}), **kwargs}
+
+		if isinstance(provider_config, (list, tuple)):
+			if not provider_config:
+				raise ValueError("Provider config list cannot be empty.")
+			call_kwargs = {
+				"messages": messages,
+				"system_prompt": system_prompt,
+				"temperature": temperature,
+				"max_tokens": max_tokens,
+				"conversation_id": conversation_id,
+				"session_id": session_id,
+				"priority": priority,
+				"timeout": timeout,
+				"extra": extra
+			}
+			return await self._failover_completion(list(provider_config), call_kwargs, hedge_after_ms)
+
+		provider = self._resolve_provider(provider_config)
+
+		# Serve a matching speculative prefetch before anything else
+		if session_id and self._prefetches:
+			prefetched = await self._take_prefetch(session_id, messages)
+			if prefetched is not None:
+				return prefetched
+
+		# Exact tier: only deterministic requests can be replayed verbatim
+		cache_key = None
+		if temperature == 0:
+			cache_key = hashlib.blake2b(orjson.dumps(
+				{'p': provider.cmd, 'm': messages, 's': system_prompt, 'x': max_tokens, 'e': extra},
+				option=orjson.OPT_SORT_KEYS
+			), digest_size=16).digest()
+			cached = self._exact_cache.get(cache_key)
+			if cached is not None:
+				return cached
+
+		# Semantic tier: single-message prompts only, where the query alone is the context
+		semantic_query = None
+		if self._semantic_cache is not None and len(messages) == 1 and messages[0].get('role') == 'user':
+			semantic_query = messages[0]['content']
+			cached = await asyncio.to_thread(self._semantic_cache.get, semantic_query)
+			if cached is not None:
+				return cached
+
+		job = {
+			"provider_config": provider,
+			"messages": messages,
+			"system_prompt": system_prompt,
+			"temperature": temperature,
+			"max_tokens": max_tokens,
+			"conversation_id": conversation_id,
+			"session_id": session_id,
+			"timeout": timeout,
+			"extra": extra
+		}
+
+		queue = self._ensure_workers(provider)
+		if queue is not None:
+			future = asyncio.get_running_loop().create_future()
+			self._job_seq += 1
+			queue.put_nowait((priority, self._job_seq, future, job))
+			r = await future
+		else:
+			r = await self._achat_completion_uncached(**job)
+
+		if cache_key is not None:
+			self._exact_cache[cache_key] = r
+		if semantic_query is not None:
+			await asyncio.to_thread(self._semantic_cache.add, semantic_query, r)
+		return r
+
+	async def _achat_completion_uncached(self,
+						provider_config: Dict[str, Any],
+						messages: List[Dict[str, str]],
+						system_prompt: Optional[str] = None,
+						temperature: float = 0.7,
+						max_tokens: Optional[int] = None,
+						conversation_id: Optional[str] = None,
+						session_id: Optional[str] = None,
+						timeout: Optional[float] = None,
+						extra: Optional[Mapping[str, Any]] = None) -> str:
+		"""Performs the actual provider request for achat_completion."""
+		if timeout is None:
+			timeout = self.default_timeout
+		provider = self._resolve_provider(provider_config)
+		provider_cmd = provider.cmd
+		display_name = provider.name
+		is_gemini = provider.is_gemini
+		model = provider.model
+
+		if not is_gemini: # OpenAI-compatible
+			openai_client = self._get_async_openai_client(provider_cmd)
+
+			# Single allocation; the SDK accepts the caller's list as-is when there's no system prompt
+			openai_messages = [{"role": "system", "content": system_prompt}, *messages] if system_prompt else messages
+
+			# Build the request args once; fields matching SDK defaults (stream=False,
+			# absent max_tokens) are omitted entirely
+			request_args = {"model": model, "messages": openai_messages, "temperature": temperature}
+			if max_tokens is not None:
+				request_args["max_tokens"] = max_tokens
+			if extra:
+				request_args.update(extra)
+
+			if session_id:
+				# Stable 'user' id keeps a conversation on the same replica behind
+				# prefix-cache-aware routers; cache_salt is the vLLM/OpenRouter equivalent
+				request_args.setdefault("user", session_id)
+				if provider.supports_cache_salt:
+					extra_body = dict(request_args.get("extra_body") or {})
+					extra_body.setdefault("cache_salt", session_id)
+					request_args["extra_body"] = extra_body
+
+			semaphore = self._semaphores.setdefault(provider_cmd, asyncio.Semaphore(8))
+			max_retries = provider.max_retries
+			for attempt in range(max_retries + 1):
+				try:
+					async with semaphore:
+						response = await openai_client.with_options(timeout=timeout).chat.completions.create(**request_args)
+					return response.choices[0].message.content
+				except Exception as e:
+					if attempt < max_retries and _is_retryable_error(e):
+						delay = random.uniform(0, 2 ** attempt) # Exponential backoff with jitter
+						logger.warning(f"Retryable error from '{display_name}' (cmd: '{provider_cmd}'): {e}. Retrying in {delay:.1f}s.")
+						await asyncio.sleep(delay)
+						continue
+					raise ChatCompletionError(f"OpenAI-compatible chat completion for '{display_name}' (cmd: '{provider_cmd}') failed: {e}")
+
+		else: # Gemini
+			if provider_cmd not in self.gemini_native_clients:
+				raise ChatCompletionError(
+					f"Gemini client '{display_name}' (cmd: '{provider_cmd}') not initialized. Check 'api_key'."
+				)
+
+			gemini_model_instance = self.gemini_native_clients[provider_cmd]
+
+			gemini_messages = self._format_gemini_messages(provider_cmd, messages, system_prompt, conversation_id)
+
+			request_args = {
+				"contents": gemini_messages,
+				"generation_config": genai.types.GenerationConfig(
+					temperature=temperature,
+					max_output_tokens=max_tokens
+				),
+				"request_options": {'timeout': timeout}
+			}
+			if extra:
+				request_args.update(extra)
+
+			semaphore = self._semaphores.setdefault(provider_cmd, asyncio.Semaphore(8))
+			max_retries = provider.max_retries
+			for attempt in range(max_retries + 1):
+				try:
+					async with semaphore:
+						response = await gemini_model_instance.generate_content_async(**request_args)
+					if response.candidates:
+						return response.candidates[0].content.parts[0].text
+					else:
+						logger.warning(f"Gemini response for '{display_name}' (cmd: '{provider_cmd}') had no candidates. Possibly blocked or empty response.")
+						return ""
+				except Exception as e:
+					if attempt < max_retries and _is_retryable_error(e):
+						delay = random.uniform(0, 2 ** attempt) # Exponential backoff with jitter
+						logger.warning(f"Retryable error from '{display_name}' (cmd: '{provider_cmd}'): {e}. Retrying in {delay:.1f}s.")
+						await asyncio.sleep(delay)
+						continue
+					raise ChatCompletionError(f"Gemini chat completion for '{display_name}' (cmd: '{provider_cmd}') failed: {e}")
+
+	async def achat_completion_stream(self,
+						provider_config: Dict[str, Any],
+						messages: List[Dict[str, str]],
+						system_prompt: Optional[str] = None,
+						temperature: float = 0.7,
+						max_tokens: Optional[int] = None,
+						timeout: Optional[float] = None,
+						**kwargs):
+		"""
+		Streams a chat completion, yielding content deltas as they arrive so
+		callers see first tokens at network latency instead of waiting for the
+		whole response. Streamed responses bypass the caches.
+		Args:
+		   Same as achat_completion; timeout defaults to the client-wide
+		   default_timeout, like the non-streaming path.
+		Yields:
+		   Non-empty content chunks, in order.
+		Raises:
+		   ChatCompletionError: If client not initialized or API call fails.
+		   ValueError: If provider config invalid.
+		"""
+		if timeout is None:
+			timeout = self.default_timeout
+		provider = self._resolve_provider(provider_config)
+		provider_cmd = provider.cmd
+		display_name = provider.name
+		is_gemini = provider.is_gemini
+		model = provider.model
+
+		semaphore = self._semaphores.setdefault(provider_cmd, asyncio.Semaphore(8))
+
+		if not is_gemini: # OpenAI-compatible
+			openai_client = self._get_async_openai_client(provider_cmd)
+
+			# Single allocation; the SDK accepts the caller's list as-is when there's no system prompt
+			openai_messages = [{"role": "system", "content": system_prompt}, *messages] if system_prompt else messages
+
+			try:
+				async with semaphore: # Held for the whole stream
+					stream = await openai_client.with_options(timeout=timeout).chat.completions.create(
+						model=model,
+						messages=openai_messages,
+						temperature=temperature,
+						max_tokens=max_tokens,
+						stream=True,
+						**kwargs
+					)
+					async for chunk in stream:
+						delta = chunk.choices[0].delta.content if chunk.choices else None
+						if delta:
+							yield delta
+			except Exception as e:
+				raise ChatCompletionError(f"OpenAI-compatible chat completion stream for '{display_name}' (cmd: '{provider_cmd}') failed: {e}")
+
+		else: # Gemini
+			if provider_cmd not in self.gemini_native_clients:
+				raise ChatCompletionError(
+					f"Gemini client '{display_name}' (cmd: '{provider_cmd}') not initialized. Check 'api_key'."
+				)
+
+			gemini_model_instance = self.gemini_native_clients[provider_cmd]
+
+			gemini_messages = self._format_gemini_messages(provider_cmd, messages, system_prompt)
+
+			try:
+				async with semaphore: # Held for the whole stream
+					response = await gemini_model_instance.generate_content_async(
+						contents=gemini_messages,
+						generation_config=genai.types.GenerationConfig(
+							temperature=temperature,
+							max_output_tokens=max_tokens
+						),
+						stream=True,
+						request_options={'timeout': timeout},
+						**kwargs
+					)
+					async for chunk in response:
+						if chunk.text:
+							yield chunk.text
+			except Exception as e:
+				raise ChatCompletionError(f"Gemini chat completion stream for '{display_name}' (cmd: '{provider_cmd}') failed: {e}")
+
+	async def achat_completion_batch(self,
+						jobs: List[Dict[str, Any]],
+						max_concurrency: Optional[int] = None,
+						return_exceptions: bool = True) -> List[Union[str, Exception]]:
+		"""
+		Performs many chat completion requests concurrently via asyncio.gather.
+		Args:
+		   jobs: List of kwargs dicts for achat_completion (provider_config, messages, ...).
+		   max_concurrency: Optional cap on in-flight requests.
+		   return_exceptions: Keep per-job exceptions in the result list instead of
+		      failing the whole batch (e.g. one 429 doesn't kill the rest).
+		Returns:
+		   Results in job order; a failed job yields its exception when return_exceptions.
+		"""
+		semaphore = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+
+		async def _run(job: Dict[str, Any]) -> str:
+			if semaphore:
+				async with semaphore:
+					return await self.achat_completion(**job)
+			return await self.achat_completion(**job)
+
+		return await asyncio.gather(*(_run(job) for job in jobs), return_exceptions=return_exceptions)
+
+	async def achat_completion_multi(self,
+						provider_config: Dict[str, Any],
+						message_lists: List[List[Dict[str, str]]],
+						system_prompt: Optional[str] = None,
+						temperature: float = 0.7,
+						max_tokens: Optional[int] = None,
+						**kwargs) -> List[str]:
+		"""
+		Performs completions for several message lists against one provider.
+		When the provider sets 'supports_prompt_list' and every list is the same
+		prompt, one request with n=len(message_lists) replaces k round trips
+		(one HTTP call, k choices, unpacked by choice index). Everything else
+		fans out concurrently via achat_completion_batch.
+		Args:
+		   provider_config: Config dict for the LLM provider.
+		   message_lists: One messages list per wanted completion.
+		   Remaining args as achat_completion.
+		Returns:
+		   One response per message list, in order.
+		"""
+		provider = self._resolve_provider(provider_config)
+		provider_cmd = provider.cmd
+		display_name = provider.name
+		is_gemini = provider.is_gemini
+		model = provider.model
+
+		if (not is_gemini and provider.supports_prompt_list
+				and len(message_lists) > 1 and all(ml == message_lists[0] for ml in message_lists)):
+			openai_client = self._get_async_openai_client(provider_cmd)
+			openai_messages = ([{"role": "system", "content": system_prompt}] if system_prompt else []) + message_lists[0]
+			try:
+				response = await openai_client.chat.completions.create(
+					model=model,
+					messages=openai_messages,
+					temperature=temperature,
+					max_tokens=max_tokens,
+					n=len(message_lists),
+					stream=False,
+					**kwargs
+				)
+				choices = sorted(response.choices, key=lambda c: c.index)
+				return [choice.message.content for choice in choices]
+			except Exception as e:
+				raise ChatCompletionError(f"OpenAI-compatible multi completion for '{display_name}' (cmd: '{provider_cmd}') failed: {e}")
+
+		jobs = [
+			{
+				"provider_config": provider_config,
+				"messages": messages,
+				"system_prompt": system_prompt,
+				"temperature": temperature,
+				"max_tokens": max_tokens,
+				**kwargs
+			}
+			for messages in message_lists
+		]
+		return await self.achat_completion_batch(jobs, return_exceptions=False)
+
+	async def submit_batch(self,
+						provider_cmd: str,
+						jobs: List[Dict[str, Any]],
+						completion_window: str = "24h") -> str:
+		"""
+		Submits jobs through the provider's Batch API - roughly half the cost of
+		synchronous calls and a separate rate-limit pool, for workloads that can
+		wait (evals, bulk summarization).
+		Args:
+		   provider_cmd: OpenAI-compatible provider to submit through.
+		   jobs: Dicts with 'custom_id' and a 'body' (messages, temperature, ...);
+		      body.model defaults to the provider's configured model.
+		   completion_window: Batch completion window.
+		Returns:
+		   The provider's batch id, for poll_batch.
+		"""
+		client = self._get_batch_client(provider_cmd)
+		default_model = self.provider_configs_by_cmd.get(provider_cmd, {}).get("model")
+
+		lines = []
+		for job in jobs:
+			body = dict(job.get("body") or {})
+			body.setdefault("model", default_model)
+			lines.append(orjson.dumps({
+				"custom_id": str(job["custom_id"]),
+				"method": "POST",
+				"url": "/v1/chat/completions",
+				"body": body
+			}))
+		payload = b"\n".join(lines) + b"\n"
+
+		batch_file = await client.files.create(file=io.BytesIO(payload), purpose="batch")
+		batch = await client.batches.create(
+			input_file_id=batch_file.id,
+			endpoint="/v1/chat/completions",
+			completion_window=completion_window
+		)
+		logger.info(f"Submitted batch '{batch.id}' with {len(jobs)} job(s) via '{provider_cmd}'.")
+		return batch.id
+
+	async def poll_batch(self,
+						provider_cmd: str,
+						batch_id: str,
+						poll_interval: float = 30.0) -> Dict[str, str]:
+		"""
+		Waits for a batch to complete and returns its results.
+		Args:
+		   provider_cmd: Provider the batch was submitted through.
+		   batch_id: Id returned by submit_batch.
+		   poll_interval: Seconds between status checks.
+		Returns:
+		   Mapping of custom_id to response content.
+		Raises:
+		   ChatCompletionError: If the batch fails, expires or is cancelled.
+		"""
+		client = self._get_batch_client(provider_cmd)
+
+		while True:
+			batch = await client.batches.retrieve(batch_id)
+			if batch.status == "completed":
+				break
+			if batch.status in ("failed", "expired", "cancelled"):
+				raise ChatCompletionError(f"Batch '{batch_id}' ended with status '{batch.status}'.")
+			await asyncio.sleep(poll_interval)
+
+		output = await client.files.content(batch.output_file_id)
+		results = {}
+		for line in output.content.splitlines():
+			if not line:
+				continue
+			record = orjson.loads(line)
+			results[record["custom_id"]] = record["response"]["body"]["choices"][0]["message"]["content"]
+		return results
+
+	def chat_completion(self,
+						provider_config: Dict[str, Any],
+						messages: List[Dict[str, str]],
+						system_prompt: Optional[str] = None,
+						temperature: float = 0.7,
+						max_tokens: Optional[int] = None,
+						**kwargs) -> str:
+		"""Synchronous wrapper around achat_completion for non-async callers.
+		Must not be called from a running event loop."""
+		return asyncio.run(self.achat_completion(
+			provider_config,
+			messages,
+			system_prompt=system_prompt,
+			temperature=temperature,
+			max_tokens=max_tokens,
+			**kwargs
+		))
@@ -0,0 +1,60 @@
+import logging
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+class SemanticCache:
+	"""In-process response cache keyed by embedding similarity.
+
+	Embeds queries with a small local model and returns the stored response
+	for the nearest neighbour when cosine similarity meets the threshold.
+	Optional feature: needs the 'fastembed' and 'hnswlib' packages; import
+	errors are raised from __init__ so the caller can disable the cache.
+	"""
+
+	def __init__(
+			self,
+			threshold: float = 0.92,
+			max_items: int = 4096,
+			model_name: str = 'sentence-transformers/all-MiniLM-L6-v2',
+			dim: int = 384
+	):
+		"""
+		Args:
+		   threshold: Minimum cosine similarity for a cache hit.
+		   max_items: Maximum cached responses; adds are dropped when full.
+		   model_name: Local embedding model passed to fastembed.
+		   dim: Embedding dimension of the model.
+		"""
+		# Optional dependencies; imported here so the bot runs without them when the cache is disabled
+		from fastembed import TextEmbedding
+		import hnswlib
+
+		self.threshold = threshold
+		self.max_items = max_items
+		self._embedder = TextEmbedding(model_name=model_name)
+		self._index = hnswlib.Index(space='cosine', dim=dim)
+		self._index.init_index(max_elements=max_items, ef_construction=200, M=16)
+		self._responses: List[str] = []
+		logger.info('SemanticCache initialized (model: %s, threshold: %s, max_items: %d).', model_name, threshold, max_items)
+
+	def _embed(self, text: str):
+		return next(iter(self._embedder.embed([text])))
+
+	def get(self, query: str) -> Optional[str]:
+		"""Returns the cached response for the most similar stored query, or None."""
+		if not self._responses:
+			return None
+		labels, distances = self._index.knn_query(self._embed(query), k=1)
+		similarity = 1.0 - float(distances[0][0]) # hnswlib cosine space returns distance = 1 - similarity
+		if similarity >= self.threshold:
+			logger.debug('Semantic cache hit (similarity: %.3f).', similarity)
+			return self._responses[int(labels[0][0])]
+		return None
+
+	def add(self, query: str, response: str) -> None:
+		"""Stores a query/response pair. No-op once the index is full."""
+		if len(self._responses) >= self.max_items:
+			return
+		self._index.add_items([self._embed(query)], [len(self._responses)])
+		self._responses.append(response)